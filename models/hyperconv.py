@@ -1,8 +1,73 @@
+from contextlib import nullcontext
+
 import torch
 import torch.nn.functional as F
 from torch.nn import Parameter
 from torch_geometric.nn.conv import MessagePassing
 from torch_geometric.nn.inits import uniform
+from torch_sparse import SparseTensor, matmul
+
+import params
+
+
+def autocast(enabled):
+    r"""
+    BF16 mixed-precision context for CUDA matmuls
+    Args:
+        enabled: False for a no-op context
+
+    Only BF16 is used: FP16 would need a GradScaler in training to keep small gradients from underflowing.
+    The context is a no-op on devices or PyTorch versions without BF16 autocast.
+    """
+    if not enabled or not hasattr(torch, 'autocast') or not torch.cuda.is_bf16_supported():
+        return nullcontext()
+    return torch.autocast(device_type='cuda', dtype=torch.bfloat16)
+
+
+def sort_edges_by_type(edge_index, edge_types, n_type):
+    r"""
+    Sorting edges by their propagation types so that each type is a contiguous segment
+    Args:
+        edge_index: (2 x num_pairs) Tensor for the source to target node
+        edge_types: (num_pairs) Tensor of types in [0, n_type)
+        n_type: number of propagation types
+
+    Returns:
+        edge_index_sorted: edge_index with the edges of the same type next to each other
+        type_offsets: list of n_type + 1 offsets, edges of type i are in [type_offsets[i], type_offsets[i + 1])
+    """
+    perm = torch.argsort(edge_types)
+    edge_index_sorted = edge_index[:, perm]
+    counts = torch.bincount(edge_types, minlength=n_type).tolist()
+    type_offsets = [0]
+    for c in counts:
+        type_offsets.append(type_offsets[-1] + c)
+    return edge_index_sorted, type_offsets
+
+
+def build_type_adjacency(edge_index, edge_types, n_type, num_nodes):
+    r"""
+    Converting the hypergraph edges into one transposed CSR adjacency per propagation type
+    Args:
+        edge_index: (2 x num_pairs) Tensor for the source to target node
+        edge_types: (num_pairs) Tensor of types in [0, n_type)
+        n_type: number of propagation types
+        num_nodes: number of nodes
+
+    Returns:
+        adj_ts: list of n_type (num_nodes x num_nodes) SparseTensor from source (column) to target (row)
+        type_deg: (num_nodes x n_type) Tensor of the number of incoming edges of each type
+    """
+    edge_index_sorted, type_offsets = sort_edges_by_type(edge_index, edge_types, n_type)
+    adj_ts = []
+    for i in range(n_type):
+        s, e = type_offsets[i], type_offsets[i + 1]
+        adj_ts.append(SparseTensor(row=edge_index_sorted[1, s:e], col=edge_index_sorted[0, s:e],
+                                   sparse_sizes=(num_nodes, num_nodes)))
+    type_deg = torch.zeros((num_nodes, n_type), device=edge_index.device)
+    type_deg.index_put_((edge_index[1, :], edge_types), torch.ones(edge_types.size(0), device=edge_index.device),
+                        accumulate=True)
+    return adj_ts, type_deg
 
 
 class HyperConv(MessagePassing):
@@ -25,30 +90,37 @@ class HyperConv(MessagePassing):
         self.n_type = n_type
         self.device = device
         in_channels = 2 * in_channels if concat else in_channels
-        self.transforms = [torch.nn.Linear(in_channels, out_channels, bias=True).to(device) for _ in range(n_type)]
+        # Stacked per-type transformations: one (in, out) weight and one bias for each propagation type
+        self.W = Parameter(torch.Tensor(n_type, in_channels, out_channels).to(device))
+        self.B = Parameter(torch.Tensor(n_type, out_channels).to(device))
         self.skip_last_weight = skip_last_weight
+        self.edge_cache = None
         self.weight = Parameter(torch.Tensor(in_channels, out_channels).to(device))
 
         if bias:
             self.bias = Parameter(torch.Tensor(out_channels).to(device))
         else:
             self.register_parameter('bias', None)
-        self.register_new_params()
         self.reset_parameters()
+        # The propagation over the cached adjacencies has no data-dependent branches: let Inductor fuse it.
+        # The number of nodes and edges differ across datasets and folds, hence dynamic shapes.
+        # Off by default (params.COMPILE): not verified with torch_sparse inputs and CUDA graphs
+        if params.COMPILE and hasattr(torch, 'compile'):
+            self.propagate = torch.compile(self.propagate, mode='reduce-overhead', dynamic=True)
 
     def reset_parameters(self):
         uniform(self.weight.size(0), self.weight)
         uniform(self.weight.size(0), self.bias)
-        for transform in self.transforms:
-            uniform(transform.weight.size(1), transform.weight)
-
-    def register_new_params(self):
-        for i, transform in enumerate(self.transforms):
-            self.register_parameter("transform_%s" % i, transform.weight)
-            self.register_parameter("bias_%s" % i, transform.bias)
+        uniform(self.W.size(1), self.W)
+        uniform(self.W.size(1), self.B)
 
     def forward(self, x, edge_index, edge_types):
-        return self.propagate(edge_index, x=x, edge_types=edge_types)
+        # The hypergraph is static across iterations: build its per-type adjacencies only once
+        if self.edge_cache is None or self.edge_cache[0] is not edge_index or self.edge_cache[1] is not edge_types:
+            adj_ts, type_deg = build_type_adjacency(edge_index, edge_types, self.n_type, x.size(0))
+            self.edge_cache = (edge_index, edge_types, adj_ts, type_deg)
+        _, _, adj_ts, type_deg = self.edge_cache
+        return self.propagate(adj_ts, type_deg, x)
 
     def message(self, x_j):
         return x_j
@@ -70,38 +142,37 @@ class HyperConv(MessagePassing):
 
         return aggr_out
 
-    def __collect__(self, edge_index, edge_types, x):
+    def __collect__(self, adj_ts, type_deg, x):
         r"""
         Collecting information passing through source-target of each pair of nodes
         Args:
-            edge_index: (2 x num_pairs) Tensor for the source to target node
-            edge_types: either 0, 1, 2, 3, 4
+            adj_ts: list of n_type transposed adjacencies (target x source), one for each type
+            type_deg: (num_nodes x n_type) Tensor of the number of incoming edges of each type
             x: Input embeddings of nodes
 
         Returns:
-            Embeddings after propagations through each pairs
+            Sum of the embeddings propagated to each target node
         """
-        n_out = edge_index.size(1)
-        x_out = torch.empty((n_out, self.out_channels), device=self.device)
-        source_ids = edge_index[0, :]
-        for i in range(self.n_type):
-            ids = torch.nonzero(edge_types == i).to(self.device)
-            x_ids = x[source_ids[ids]]
-            x_out_v = self.transforms[i](x_ids)
-            x_out[ids] = x_out_v
+        # Transform all nodes with all types in a single batched matmul: (n_type x num_nodes x out_channels)
+        with autocast(params.MIXED_PRECISION and x.is_cuda):
+            x_w = torch.matmul(x.unsqueeze(0), self.W)
+        # The sparse aggregation runs in full precision
+        x_w = x_w.float()
+        # Each incoming edge of type i also carries the bias B[i]
+        x_out = torch.matmul(type_deg, self.B)
+        for i, adj_t in enumerate(adj_ts):
+            x_out = x_out + matmul(adj_t, x_w[i], reduce='sum')
         return x_out
 
-    def propagate(self, edge_index, edge_types, x):
-
-        mp_type = self.__get_mp_type__(edge_index)
-        assert mp_type == 'edge_index'
-        x_out = self.__collect__(edge_index, edge_types, x)
-        out = self.message(x_out)
-        out = self.aggregate(out, edge_index[1, :])
+    def propagate(self, adj_ts, type_deg, x):
+        x_out = self.__collect__(adj_ts, type_deg, x)
+        # Mean over all incoming edges of all types
+        deg = type_deg.sum(dim=1, keepdim=True).clamp(min=1)
+        out = x_out / deg
         out = self.update(out, x)
 
         return out
 
     def __repr__(self):
-        return '{}({}, {})'.format(self.__class__.__name__, self.in_channels,
-                                   self.out_channels)
+        return '{}({}, {}, n_type={})'.format(self.__class__.__name__, self.in_channels,
+                                              self.out_channels, self.n_type)
@@ -65,6 +65,8 @@ KSPACE = False
 
 D_PREF = ""
 FAST_TRAINING = True
+MIXED_PRECISION = True
+COMPILE = False
 HIGH_TWOSIDES = False
 CHECKPOINT_ITER = 5000
 VALIDATE = False
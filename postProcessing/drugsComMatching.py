@@ -1,9 +1,17 @@
-from selenium import webdriver
+import asyncio
+import aiohttp
+import json
+import os
+import queue
+import re
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from utils import utils
-from bs4 import BeautifulSoup
-import params
+from lxml import etree, html as lhtml
+from selenium import webdriver
 from selenium.webdriver.common.by import By
+import params
 
 Pref = "https://www.drugs.com/js/search/?id=livesearch-interaction&s="
 INTER_PREF = "https://www.drugs.com/interactions-check.php?drug_list="
@@ -13,6 +21,181 @@ DRUG_WEB_ID_PATH = params.DRUGSCOM_DRUG_ID_WEB
 PREDICTION_PATH = "%s/TopPredictedTriples.txt" % params.TMP_DIR
 RAW_RES_INTER = "%s/RawDrugComResponse.dat" % params.TMP_DIR
 
+N_CONCURRENT = 8
+REQUEST_RATE = 2  # Maximum number of requests per second to drugs.com
+N_BROWSERS = 4
+BROWSER_RATE = 1  # Maximum number of pages per second loaded by all the browsers together
+# Pre-compiled selectors, matching a class among the (space-separated) classes of an element
+LS_ITEM_ONCLICK = etree.XPath('//a[contains(concat(" ", normalize-space(@class), " "), " ls-item ")]/@onclick')
+REFERENCE_DIV = etree.XPath(
+    '//div[contains(concat(" ", normalize-space(@class), " "), " interactions-reference-wrapper ")]')
+# Arguments of DDC.Interaction.List.addDrug(...) in the onclick of a live search item
+ONCLICK_ARGS = re.compile(r"\(([^)]*)\)")
+HEADERS = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0 Safari/537.36"}
+
+
+class RateLimiter:
+    r"""
+    Token bucket limiting the rate of requests to a host
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.lastTime = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.lastTime) * self.rate)
+                self.lastTime = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def loadRawResponses(path):
+    r"""
+    Loading the raw responses saved as a dictionary at path, updated with the append-only log at path.jsonl
+    Args:
+        path: The path to the raw responses
+
+    Returns:
+        A dictionary from keys to raw responses
+    """
+    try:
+        dKey2Re = utils.load_obj(path)
+    except:
+        dKey2Re = dict()
+    try:
+        fin = open("%s.jsonl" % path)
+    except FileNotFoundError:
+        return dKey2Re
+    for line in fin:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # A partial last line from an interrupted run
+            continue
+        dKey2Re[record['k']] = record['v']
+    fin.close()
+    return dKey2Re
+
+
+class ThreadRateLimiter:
+    r"""
+    Rate limiter shared by threads: each call of acquire waits for the next free slot
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.nextTime = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            waitTime = self.nextTime - now
+            self.nextTime = max(now, self.nextTime) + self.interval
+        if waitTime > 0:
+            time.sleep(waitTime)
+
+
+async def __fetchAll(dKey2URL, dKey2Re, fLog):
+    semaphore = asyncio.Semaphore(N_CONCURRENT)
+    limiter = RateLimiter(REQUEST_RATE)
+    async with aiohttp.ClientSession(headers=HEADERS) as session:
+        async def fetch(key, urlx):
+            async with semaphore:
+                await limiter.acquire()
+                try:
+                    async with session.get(urlx) as response:
+                        status = response.status
+                        html = await response.text()
+                except Exception as e:
+                    print(e)
+                    return
+                # Error and anti-bot pages are not kept, so that the key is retried on the next run
+                if status != 200:
+                    print("\n HTTP %s for %s" % (status, key))
+                    return
+                dKey2Re[key] = html
+                fLog.write("%s\n" % json.dumps({'k': key, 'v': html}))
+                fLog.flush()
+                print("\r %s, %s" % (len(dKey2Re), key), end="")
+
+        await asyncio.gather(*[fetch(key, urlx) for key, urlx in dKey2URL.items()])
+
+
+def fetchAll(dKey2URL, dKey2Re, pOut):
+    r"""
+    Concurrently downloading the raw responses from drugs.com
+    Args:
+        dKey2URL: dictionary from keys to URLs to download
+        dKey2Re: dictionary from keys to raw responses, updated with the new responses
+        pOut: the path of the raw responses, each new response is appended to the log at pOut.jsonl
+
+    """
+    fLog = open("%s.jsonl" % pOut, "a")
+    asyncio.run(__fetchAll(dKey2URL, dKey2Re, fLog))
+    fLog.close()
+
+
+def fetchAllBrowser(dKey2URL, dKey2Re, pOut):
+    r"""
+    Downloading the raw responses from drugs.com with a pool of Selenium browsers, for pages that may need a
+    browser to render
+    Args:
+        dKey2URL: dictionary from keys to URLs to download
+        dKey2Re: dictionary from keys to raw responses, updated with the new responses
+        pOut: the path of the raw responses, each new response is appended to the log at pOut.jsonl
+
+    """
+    if len(dKey2URL) == 0:
+        return
+    items = queue.Queue()
+    for item in dKey2URL.items():
+        items.put(item)
+    limiter = ThreadRateLimiter(BROWSER_RATE)
+    lock = threading.Lock()
+    fLog = open("%s.jsonl" % pOut, "a")
+
+    def worker():
+        browser = webdriver.Chrome()
+        try:
+            while True:
+                try:
+                    key, urlx = items.get_nowait()
+                except queue.Empty:
+                    return
+                limiter.acquire()
+                try:
+                    browser.get(urlx)
+                    html = browser.find_elements(By.TAG_NAME, 'body')[0]
+                    html = html.get_attribute('innerHTML')
+                except Exception as e:
+                    print(e)
+                    continue
+                with lock:
+                    dKey2Re[key] = html
+                    fLog.write("%s\n" % json.dumps({'k': key, 'v': html}))
+                    fLog.flush()
+                    print("\r %s, %s" % (len(dKey2Re), key), end="")
+        finally:
+            browser.quit()
+
+    nBrowser = min(N_BROWSERS, len(dKey2URL))
+    try:
+        with ThreadPoolExecutor(max_workers=nBrowser) as executor:
+            futures = [executor.submit(worker) for _ in range(nBrowser)]
+            for future in futures:
+                # Re-raise errors such as a browser failing to start
+                future.result()
+    finally:
+        fLog.close()
+
 
 def loadDrugList():
     r"""
@@ -46,29 +229,16 @@ def downloadDrugWebId():
     Getting raw responses from drugs.com for mapping from drug names to drug ids
     The result is saved in RAW_DRUG_TEXT
     """
-    browser = webdriver.Chrome()
-
     drugList = loadDrugList()
-    try:
-        dDrugName2Re = utils.load_obj(RAW_DRUG_TEXT)
-    except:
-        dDrugName2Re = dict()
+    dDrugName2Re = loadRawResponses(RAW_DRUG_TEXT)
 
+    dDrugName2URL = dict()
     for drug in drugList:
         if drug in dDrugName2Re:
             continue
-        print("\r %s, %s" % (len(dDrugName2Re), drug), end="")
-        urlx = getRetrieveDrugURL(drug)
-        browser.get(urlx)
-        html = browser.find_elements(By.TAG_NAME, 'body')[0]
-        html = html.get_attribute('innerHTML')
-        dDrugName2Re[drug] = html
-        time.sleep(3)
-        if len(dDrugName2Re) % 10 == 0:
-            utils.save_obj(dDrugName2Re, RAW_DRUG_TEXT)
-            print(html)
+        dDrugName2URL[drug] = getRetrieveDrugURL(drug)
 
-    utils.save_obj(dDrugName2Re, RAW_DRUG_TEXT)
+    fetchAll(dDrugName2URL, dDrugName2Re, RAW_DRUG_TEXT)
 
 
 def parsex(pin=RAW_DRUG_TEXT, pout=DRUG_WEB_ID_PATH):
@@ -80,27 +250,26 @@ def parsex(pin=RAW_DRUG_TEXT, pout=DRUG_WEB_ID_PATH):
 
 
     """
-    d = utils.load_obj(pin)
+    d = loadRawResponses(pin)
     fout = open(pout, "w")
     for k, v in d.items():
-        rex = []
+        # Only HTML responses hold a live search item, skip the others without parsing them
+        if not v.lstrip().startswith("<"):
+            continue
         try:
-            vbody = BeautifulSoup(v, "html.parser")
-            c = vbody.find('a', {"class": "ls-item"})
-            txt = c['onclick']
-            i1 = txt.index('(')
-            i2 = txt.index(')')
-            re = txt[i1 + 1:i2]
-            parts = re.split(",")
-
-            for part in parts:
-                part = part.strip()
-                val = part[1:-1]
-                rex.append(val)
-            # if not rex[-1] == k:
-            #     rex = []
-        except:
-            pass
+            vbody = lhtml.fromstring(v)
+        except (etree.ParserError, ValueError):
+            # Only a comment/doctype or text with an XML encoding declaration
+            continue
+        onclicks = LS_ITEM_ONCLICK(vbody)
+        if len(onclicks) == 0:
+            continue
+        args = ONCLICK_ARGS.search(onclicks[0])
+        if args is None:
+            continue
+        rex = [part.strip()[1:-1] for part in args.group(1).split(",")]
+        # if not rex[-1] == k:
+        #     rex = []
         if len(rex) > 0:
             fout.write("%s||%s\n" % (k, ",".join(rex)))
     fout.close()
@@ -121,14 +290,8 @@ def getInteractions(drugWebIdPath=DRUG_WEB_ID_PATH, predictionPath=PREDICTION_PA
     lines = fin.readlines()
     dDrugName2WebId = dict()
 
-    browser = webdriver.Chrome()
-
-    dDrugPairToRe = dict()
     print("Start...")
-    try:
-        dDrugPairToRe = utils.load_obj(pOut)
-    except:
-        pass
+    dDrugPairToRe = loadRawResponses(pOut)
     print("Init len: ", len(dDrugPairToRe))
     for line in lines:
         line = line.strip()
@@ -139,89 +302,95 @@ def getInteractions(drugWebIdPath=DRUG_WEB_ID_PATH, predictionPath=PREDICTION_PA
         k2 = info[1]
         dDrugName2WebId[drugName] = "%s-%s" % (k1, k2)
     fin.close()
-    try:
-        currentRe = utils.load_obj(pOut)
-    except:
-        currentRe = {}
-    validDrugs = dDrugName2WebId.keys()
+    currentRe = frozenset(dDrugPairToRe)
+    validDrugs = frozenset(dDrugName2WebId)
     print("N valid drugs: ", len(validDrugs))
 
-    # exit(-1)
-    def srt(v1, v2):
-        if v1 > v2:
-            v1, v2 = v2, v1
-        return v1, v2
-
     fin = open(predictionPath)
-    lines = fin.readlines()
     print("Loop")
-    for line in lines:
+    dDrugPair2URL = dict()
+    for line in fin:
         # print(line)
         try:
-            line = line.strip().lower()
-            parts = line.split(",")
+            parts = line.lower().split(",")
             d1 = parts[0].strip()
             d2 = parts[1].strip()
-            d1, d2 = srt(d1, d2)
+            if d1 > d2:
+                d1, d2 = d2, d1
             if d1 not in validDrugs or d2 not in validDrugs:
                 continue
             p = "%s,%s" % (d1, d2)
             if p in currentRe:
                 continue
 
-            pair = "%s,%s" % (dDrugName2WebId[d1], dDrugName2WebId[d2])
-            urlx = "%s%s" % (INTER_PREF, pair)
-            print("\r %s, %s, %s" % (len(dDrugPairToRe), p, urlx), end="")
-
-            browser.get(urlx)
-            html = browser.find_elements(By.TAG_NAME, 'body')[0]
-            html = html.get_attribute('innerHTML')
-            dDrugPairToRe[p] = html
-            time.sleep(4)
-            if len(dDrugPairToRe) % 10 == 0:
-                utils.save_obj(dDrugPairToRe, pOut)
-                print(html[:20])
+            dDrugPair2URL[p] = "%s%s,%s" % (INTER_PREF, dDrugName2WebId[d1], dDrugName2WebId[d2])
         except Exception as e:
             print(e)
             continue
+    fin.close()
 
-    utils.save_obj(dDrugPairToRe, pOut)
+    # The interaction checker is loaded in a browser as its content may be rendered by JavaScript
+    fetchAllBrowser(dDrugPair2URL, dDrugPairToRe, pOut)
+
+
+def parseInteraction(v):
+    r"""
+    Extracting the interaction description from a raw response of drugs.com
+    Args:
+        v: the raw response for a drug pair
+
+    Returns:
+        isNoMatch: True if drugs.com found no interaction for the pair
+        description: the joined paragraphs of the interactions, None if they could not be extracted
+    """
+    try:
+        vbody = lhtml.fromstring(v)
+    except (etree.ParserError, ValueError) as e:
+        # Empty responses or text with an XML encoding declaration
+        print("1 Error in No Matching")
+        print(e)
+        return False, None
+    divs = REFERENCE_DIV(vbody)
+    div = divs[0] if len(divs) > 0 else None
+    isNoMatch = False
+    try:
+        if div.text_content().__contains__('No interactions were found between the drugs in your list.'):
+            isNoMatch = True
+    except Exception as e:
+        print("1 Error in No Matching")
+        print(e)
+        pass
+
+    description = None
+    if not isNoMatch:
+        try:
+            pp = div.iter("p")
+            pr = []
+            for p in pp:
+                txt = p.text_content()
+                pr.append(txt)
+            description = ". ".join(pr).replace("\n", ". ")
+        except Exception as e:
+            print("- Error In Matching")
+            print(e)
+    return isNoMatch, description
 
 
 def extractInteraction():
     r"""
     Extracting drug-drug interactions information from raw responses of drugs.com
+    The responses are parsed in parallel, the results are written by the main process
     """
     fMatching = open("%s/PairMatching.txt" % params.TMP_DIR, "w")
     fnoMatching = open("%s/PairNoMatching.txt" % params.TMP_DIR, "w")
-    d = utils.load_obj(RAW_RES_INTER)
-    cc = 0
+    d = loadRawResponses(RAW_RES_INTER)
     print("N Pais: ", len(d))
-    for k, v in d.items():
-        cc += 1
-        vbody = BeautifulSoup(v, "html.parser")
-        div = vbody.find("div", {'class': 'interactions-reference-wrapper'})
-        isNoMatch = False
-        try:
-            if div.text.__contains__('No interactions were found between the drugs in your list.'):
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for k, (isNoMatch, description) in zip(d.keys(), executor.map(parseInteraction, d.values(), chunksize=64)):
+            if isNoMatch:
                 fnoMatching.write("%s\n" % k)
-                isNoMatch = True
-        except Exception as e:
-            print("1 Error in No Matching")
-            print(e)
-            pass
-
-        if not isNoMatch:
-            try:
-                pp = div.findAll("p")
-                pr = []
-                for p in pp:
-                    txt = p.text
-                    pr.append(txt)
-                fMatching.write("%s||%s\n" % (k, ". ".join(pr).replace("\n", ". ")))
-            except Exception as e:
-                print("- Error In Matching")
-                print(e)
+            elif description is not None:
+                fMatching.write("%s||%s\n" % (k, description))
 
     fMatching.close()
     fnoMatching.close()